@@ -19,7 +19,33 @@
 
 import json
 import re
-from collections import UserList
+import sqlite3
+
+
+# Products may still give their price as a string, e.g. "47.00GBP", rather than
+# as an "int_price" in pence, which the example repository now uses.
+_PRICE_RE = re.compile(r'(\d+)\.(\d+)GBP')
+
+# Queries are built once here rather than per call, so each call site passes
+# sqlite3 an identical string and hits its prepared statement cache. Columns
+# are named for use with sqlite3.Row, which each reading cursor sets as its
+# row factory, so any plain sqlite3 connection can be used.
+_SELECT_PRODUCTS = """SELECT rowid AS id, name, brand, price, in_stock_quantity
+                      FROM products"""
+_SELECT_PRODUCT_BY_ID = _SELECT_PRODUCTS + " WHERE rowid = ?"
+_SELECT_GIFTS = """SELECT wg.rowid AS gift_id, wg.purchased,
+                          p.rowid AS id, p.name, p.brand, p.price,
+                          p.in_stock_quantity
+                   FROM wedding_gift wg
+                   JOIN products p ON p.rowid = wg.product_id"""
+_SELECT_ALL_GIFTS = _SELECT_GIFTS + " ORDER BY wg.rowid"
+_SELECT_GIFT_BY_ID = _SELECT_GIFTS + " WHERE wg.rowid = ?"
+_INSERT_GIFT = """INSERT INTO wedding_gift (product_id, purchased)
+                  VALUES (?, ?)"""
+_INSERT_GIFT_FOR_PRODUCT_ID = """INSERT INTO wedding_gift
+                                 (product_id, purchased)
+                                 SELECT rowid, 0 FROM products
+                                 WHERE rowid = ?"""
 
 
 class OutOfStock(Exception):
@@ -32,10 +58,18 @@ class UnknownProduct(Exception):
     """
 
 
+class UnknownGift(Exception):
+    """Exception indicating that a gift is not known.
+    """
+
+
 class Product:
     """An product that could be given as a gift.
     """
 
+    __slots__ = ('db_conn', 'product_id', 'name', 'brand', 'price',
+                 'in_stock_quantity')
+
     def __init__(self, db_conn, from_dict=None):
         """Create a description of a product, including current stock quantity.
 
@@ -52,10 +86,8 @@ class Product:
             if "int_price" in from_dict:
                 self.price = from_dict["int_price"]
             elif "price" in from_dict:
-                price_re = re.compile(r'(\d+)\.(\d+)GBP')
-                price_match = price_re.match(from_dict["price"])
-                self.price = int(price_match.groups()[0]) * 100 + \
-                             int(price_match.groups()[1])
+                price_group = _PRICE_RE.match(from_dict["price"]).group
+                self.price = int(price_group(1)) * 100 + int(price_group(2))
             else:
                 raise Exception("Price is missing! %s" % str(from_dict))
             self.in_stock_quantity = from_dict["in_stock_quantity"]
@@ -63,6 +95,20 @@ class Product:
     def purchase(self):
         """Purchase product as gift item.
 
+        Raises:
+            OutOfStock if product is out of stock.
+        """
+        with self.db_conn:
+            self._purchase_no_commit(self.db_conn)
+
+    def _purchase_no_commit(self, db_conn):
+        """Take product from stock without committing the transaction.
+
+        Allows the stock update to be part of a larger transaction.
+
+        Args:
+            db_conn: sqlite3 database context to write the stock update with.
+
         Raises:
             OutOfStock if product is out of stock.
         """
@@ -70,11 +116,9 @@ class Product:
             self.in_stock_quantity = self.in_stock_quantity - 1
 
             # Write back to database.
-            cur = self.db_conn.cursor()
-            cur.execute("""UPDATE products SET in_stock_quantity = ?
-                           WHERE rowid = ?""", (self.in_stock_quantity,
-                                                self.product_id))
-            self.db_conn.commit()
+            db_conn.execute("""UPDATE products SET in_stock_quantity = ?
+                               WHERE rowid = ?""", (self.in_stock_quantity,
+                                                    self.product_id))
 
         else:
             raise OutOfStock("Product out of stock!")
@@ -105,16 +149,29 @@ class Product:
             collection of rows from database.
         """
         cur = db_conn.cursor()
-        cur.execute("""SELECT rowid, name, brand, price, in_stock_quantity
-                       FROM products""")
-        rows = cur.fetchall()
+        cur.row_factory = sqlite3.Row
+        cur.execute(_SELECT_PRODUCTS)
 
-        return [Product(db_conn, from_dict={"id": product[0],
-                                            "name": product[1],
-                                            "brand": product[2],
-                                            "int_price": product[3],
-                                            "in_stock_quantity": product[4]
-                                           }) for product in rows]
+        return [Product._from_row(db_conn, product) for product in cur]
+
+    @staticmethod
+    def rows_to_json(db_conn):
+        """Gets current repository of gift items from database as JSON.
+
+        Only for reading; no Product objects are created, so the result is the
+        same as the JSON form of get_gift_repository but cheaper to build.
+
+        Args:
+            db_conn: an sqlite3 database context.
+
+        Returns:
+            A JSON-serializable object.
+        """
+        cur = db_conn.cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute(_SELECT_PRODUCTS)
+
+        return [dict(product) for product in cur]
 
     @staticmethod
     def get_product_by_id(db_conn, product_id):
@@ -130,16 +187,34 @@ class Product:
         Raises:
             UnknownProduct if the product could not be found in the database.
         """
-        products = Product.get_gift_repository(db_conn)
+        cur = db_conn.cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute(_SELECT_PRODUCT_BY_ID, (product_id,))
+        product = cur.fetchone()
 
-        try:
-            # Attempt to look up product.
-            return [product for product in products
-                    if product.product_id == product_id][0]
-        except IndexError:
+        if product is None:
             raise UnknownProduct
 
-    @property
+        return Product._from_row(db_conn, product)
+
+    @staticmethod
+    def _from_row(db_conn, row):
+        """Create a Product from a database row.
+
+        Args:
+            db_conn: sqlite3 database connection.
+            row: sqlite3.Row with id, name, brand, price and in_stock_quantity.
+
+        Returns:
+            Product described by the row.
+        """
+        return Product(db_conn, from_dict={"id": row["id"],
+                                           "name": row["name"],
+                                           "brand": row["brand"],
+                                           "int_price": row["price"],
+                                           "in_stock_quantity":
+                                               row["in_stock_quantity"]})
+
     def to_json(self):
         """A JSON-serializable object.
 
@@ -157,6 +232,8 @@ class GiftItem:
     """An item that could be given as a gift.
     """
 
+    __slots__ = ('db_conn', 'gift_id', 'product', '_purchased')
+
     def __init__(self, db_conn, gift_id, product, purchased=False):
         """Create a gift item as an entry for wedding list.
 
@@ -179,15 +256,16 @@ class GiftItem:
             OutOfStock if product is out of stock.
         """
 
-        self.product.purchase()
-        # Assuming OutOfStock was not raised, mark as purchased.
-        self._purchased = True
+        # Stock and gift updates are committed together as one transaction.
+        with self.db_conn:
+            #pylint: disable=protected-access
+            self.product._purchase_no_commit(self.db_conn)
+            # Assuming OutOfStock was not raised, mark as purchased.
+            self._purchased = True
 
-        # Write back to database.
-        cur = self.db_conn.cursor()
-        cur.execute("""UPDATE wedding_gift SET purchased = ?
-                       WHERE rowid = ?""", (1, self.gift_id))
-        self.db_conn.commit()
+            # Write back to database.
+            self.db_conn.execute("""UPDATE wedding_gift SET purchased = ?
+                                    WHERE rowid = ?""", (1, self.gift_id))
 
     @property
     def purchased(self):
@@ -207,9 +285,9 @@ class GiftItem:
 
         Important: ensure GiftItem object is discarded after user.
         """
-        cur = self.db_conn.cursor()
-        cur.execute("DELETE FROM wedding_gift WHERE rowid = ?", (self.gift_id,))
-        self.db_conn.commit()
+        with self.db_conn:
+            self.db_conn.execute("DELETE FROM wedding_gift WHERE rowid = ?",
+                                 (self.gift_id,))
 
     @staticmethod
     def get_new_gift_item(db_conn, product):
@@ -220,15 +298,110 @@ class GiftItem:
             product: Product that will be this gift item.
         """
 
-        cur = db_conn.cursor()
-        cur.execute("""INSERT INTO wedding_gift (product_id, purchased)
-                           VALUES (?, ?)""", (product.product_id, 0))
-        db_conn.commit()
+        with db_conn:
+            cur = db_conn.execute(_INSERT_GIFT, (product.product_id, 0))
         gift_row_id = cur.lastrowid
 
         return GiftItem(db_conn, gift_row_id, product)
 
-    @property
+    @staticmethod
+    def get_new_gift_id(db_conn, product_id):
+        """Add a new gift item for a product, knowing only the product's ID.
+
+        The product is checked for and the gift item added by one statement,
+        without loading the product.
+
+        Args:
+            db_conn: sqlite3 database context.
+            product_id: ID of Product that will be this gift item.
+
+        Returns:
+            ID of the new gift item.
+
+        Raises:
+            UnknownProduct if the product could not be found in the database.
+        """
+
+        with db_conn:
+            cur = db_conn.execute(_INSERT_GIFT_FOR_PRODUCT_ID, (product_id,))
+
+        if cur.rowcount == 0:
+            raise UnknownProduct
+
+        return cur.lastrowid
+
+    @staticmethod
+    def get_new_gift_ids(db_conn, product_ids):
+        """Add several new gift items at once, knowing only product IDs.
+
+        All of the gift items are added in a single transaction, so if any
+        product could not be found none of them are added.
+
+        Args:
+            db_conn: sqlite3 database context.
+            product_ids: IDs of Products that will be the gift items.
+
+        Returns:
+            list of IDs of the new gift items, in the same order as
+            product_ids.
+
+        Raises:
+            UnknownProduct, with the ID of the product, if a product could not
+            be found in the database.
+        """
+
+        gift_ids = []
+        with db_conn:
+            for product_id in product_ids:
+                cur = db_conn.execute(_INSERT_GIFT_FOR_PRODUCT_ID,
+                                      (product_id,))
+                if cur.rowcount == 0:
+                    raise UnknownProduct(product_id)
+                gift_ids.append(cur.lastrowid)
+
+        return gift_ids
+
+    @staticmethod
+    def get_by_id(db_conn, gift_id):
+        """Look up GiftItem in database based on its gift ID.
+
+        Args:
+            db_conn: sqlite3 database connection.
+            gift_id: ID of GiftItem to lookup.
+
+        Returns:
+            GiftItem that was found.
+
+        Raises:
+            UnknownGift if the gift could not be found in the database.
+        """
+        cur = db_conn.cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute(_SELECT_GIFT_BY_ID, (gift_id,))
+        gift = cur.fetchone()
+
+        if gift is None:
+            raise UnknownGift
+
+        return GiftItem._from_row(db_conn, gift)
+
+    @staticmethod
+    def _from_row(db_conn, row):
+        """Create a GiftItem, with its Product, from a database row.
+
+        Args:
+            db_conn: sqlite3 database connection.
+            row: sqlite3.Row with gift_id and purchased, as well as the
+                columns of the gift's product.
+
+        Returns:
+            GiftItem described by the row.
+        """
+        #pylint: disable=protected-access
+        return GiftItem(db_conn, row["gift_id"],
+                        Product._from_row(db_conn, row),
+                        purchased=(row["purchased"] > 0))
+
     def to_json(self):
         """A JSON-serializable object.
 
@@ -240,8 +413,7 @@ class GiftItem:
                 "purchased": self.purchased}
 
 
-#pylint: disable=too-many-ancestors
-class WeddingList(UserList):
+class WeddingList(list):
     """List of wedding gift items.
 
     >>> db_conn = get_db()
@@ -266,9 +438,6 @@ class WeddingList(UserList):
     >>> print(json.dumps(wedding_list))
     """
 
-    def __init__(self, *args):
-        super(WeddingList, self).__init__(*args)
-
     def purchase_gift(self, gift):
         """Purchase a gift from the list.
 
@@ -276,9 +445,11 @@ class WeddingList(UserList):
             gift: The gift to purchase from the list.
 
         Raises:
-            Exception if gift isn't in the list.
+            ValueError if gift isn't in the list.
         """
-        self[self.index(gift)].purchase()
+        if gift not in self:
+            raise ValueError("Gift is not in the wedding list!")
+        gift.purchase()
 
     def get_purchased_gift(self):
         """Get list of purchased gifted.
@@ -296,6 +467,18 @@ class WeddingList(UserList):
         """
         return [a for a in self if not a.purchased]
 
+    def _partition(self):
+        """Split gifts by whether they have been purchased, in one pass.
+
+        Returns:
+            tuple of list of purchased gifts and list of gifts not yet
+            purchased.
+        """
+        purchased, non_purchased = [], []
+        for gift in self:
+            (purchased if gift.purchased else non_purchased).append(gift)
+        return purchased, non_purchased
+
     @staticmethod
     def get_wedding_gifts(db_conn):
         """Gets current list of wedding gifts from database.
@@ -305,25 +488,90 @@ class WeddingList(UserList):
 
         Returns:
             collection of rows from database.
+        """
+        rows = WeddingList._query_gifts(db_conn)
 
-        Raises:
-            UnknownProduct if the product could not be found in the database.
+        #pylint: disable=protected-access
+        return [GiftItem._from_row(db_conn, gift) for gift in rows]
+
+    @staticmethod
+    def rows_to_json(db_conn):
+        """Gets current list of wedding gifts from database as JSON.
+
+        Only for reading; no GiftItem or Product objects are created, so the
+        result is the same as the JSON form of get_wedding_gifts but can be
+        encoded without calling back into Python for each object.
+
+        Args:
+            db_conn: sqlite3 database context.
+
+        Returns:
+            A JSON-serializable object.
+        """
+        return WeddingList._rows_to_json(WeddingList._query_gifts(db_conn))
+
+    @staticmethod
+    def get_report(db_conn):
+        """Gets a report of the wedding list straight from the database.
+
+        Equivalent to the JSON form of a WeddingList holding every gift. Both
+        sections are split from a single query, so they are read from the same
+        snapshot of the database.
+
+        Args:
+            db_conn: sqlite3 database context.
+
+        Returns:
+            A JSON-serializable object.
+        """
+        purchased, non_purchased = [], []
+        for gift in WeddingList._rows_to_json(
+                WeddingList._query_gifts(db_conn)):
+            (purchased if gift["purchased"] else non_purchased).append(gift)
+        return {"purchased_gifts": purchased,
+                "not_purchased_gifts": non_purchased}
+
+    @staticmethod
+    def _query_gifts(db_conn):
+        """Gets rows of all wedding gifts.
+
+        Args:
+            db_conn: sqlite3 database context.
+
+        Returns:
+            cursor over gift rows, including the columns of each gift's
+            product.
         """
         cur = db_conn.cursor()
-        cur.execute("SELECT rowid, product_id, purchased FROM wedding_gift")
-        rows = cur.fetchall()
+        cur.row_factory = sqlite3.Row
+        cur.execute(_SELECT_ALL_GIFTS)
+        return cur
 
-        return [GiftItem(db_conn, gift[0],
-                         Product.get_product_by_id(db_conn, gift[1]),
-                         purchased=(gift[2] > 0))
+    @staticmethod
+    def _rows_to_json(rows):
+        """Convert rows of wedding gifts to the JSON form of GiftItems.
+
+        Args:
+            rows: gift rows from _query_gifts.
+
+        Returns:
+            A JSON-serializable object.
+        """
+        return [{"id": gift["gift_id"],
+                 "product": {"id": gift["id"],
+                             "name": gift["name"],
+                             "brand": gift["brand"],
+                             "price": gift["price"],
+                             "in_stock_quantity": gift["in_stock_quantity"]},
+                 "purchased": gift["purchased"] > 0}
                 for gift in rows]
 
-    @property
     def to_json(self):
         """A JSON-serializable object.
 
         Returns:
             A JSON-serializable object.
         """
-        return {"purchased_gifts": self.get_purchased_gift(),
-                "not_purchased_gifts": self.get_non_purchased_gift()}
+        purchased, non_purchased = self._partition()
+        return {"purchased_gifts": purchased,
+                "not_purchased_gifts": non_purchased}
@@ -62,10 +62,16 @@ from model import Product
 from model import GiftItem
 from model import WeddingList
 from wedding_lister import app
+from wedding_lister import close_pool
 from wedding_lister import get_db
 from wedding_lister import init_db
 
 
+# Seed a database once; each test starts from a copy of it.
+TEMPLATE_DB = sqlite3.connect(":memory:")
+init_db(TEMPLATE_DB)
+
+
 class TestWeddingListerUnits(unittest.TestCase):
     """Unit tests for Wedding List Organiser.
     """
@@ -76,7 +82,7 @@ class TestWeddingListerUnits(unittest.TestCase):
 
         self.db_fd, self.db_path = tempfile.mkstemp()
         self.db_conn = sqlite3.connect(self.db_path)
-        init_db(self.db_conn)
+        TEMPLATE_DB.backup(self.db_conn)
 
     def tearDown(self):
         """Tear down test context.
@@ -94,6 +100,25 @@ class TestWeddingListerUnits(unittest.TestCase):
 
         self.assertEqual(len(gift_repo), 20)
 
+    def test_database_prices_match_example_repository(self):
+        """Test that product prices are stored in pounds, from pence.
+        """
+
+        example_repo = Product.get_example_gift_repository(self.db_conn)
+        gift_repo = Product.get_gift_repository(self.db_conn)
+
+        self.assertEqual([product.price for product in gift_repo],
+                         [product.price / 100. for product in example_repo])
+
+    def test_product_rows_match_product_json(self):
+        """Test that product rows read as JSON match the JSON of Products.
+        """
+
+        gift_repo = Product.get_gift_repository(self.db_conn)
+
+        self.assertEqual(Product.rows_to_json(self.db_conn),
+                         [product.to_json() for product in gift_repo])
+
     def test_can_purchase_product_from_stock(self):
         """Test that we can purchase a product from stock.
         """
@@ -109,6 +134,19 @@ class TestWeddingListerUnits(unittest.TestCase):
 
         self.assertEqual(product.in_stock_quantity, original_stock_level - 1)
 
+    def test_product_lookup_reflects_purchase(self):
+        """Test that looking up a product again sees its updated stock level.
+        """
+
+        product = Product.get_product_by_id(self.db_conn, 1)
+        original_stock_level = product.in_stock_quantity
+
+        product.purchase()
+
+        product = Product.get_product_by_id(self.db_conn, 1)
+
+        self.assertEqual(product.in_stock_quantity, original_stock_level - 1)
+
     def test_wedding_list_is_list(self):
         """Test core wedding list functionality.
         """
@@ -131,6 +169,36 @@ class TestWeddingListerUnits(unittest.TestCase):
 
         self.assertEqual(wedding_list, [])
 
+    def test_wedding_list_json_splits_purchased_gifts(self):
+        """Test that the JSON of a wedding list is split by purchase status.
+        """
+
+        products = Product.get_gift_repository(self.db_conn)[:3]
+        wedding_list = WeddingList(GiftItem.get_new_gift_item(self.db_conn,
+                                                              product)
+                                   for product in products)
+
+        wedding_list.purchase_gift(wedding_list[1])
+
+        json_data = wedding_list.to_json()
+
+        self.assertEqual(json_data['purchased_gifts'], [wedding_list[1]])
+        self.assertEqual(json_data['not_purchased_gifts'],
+                         [wedding_list[0], wedding_list[2]])
+
+    def test_wedding_list_rows_match_gift_json(self):
+        """Test that gift rows read as JSON match the JSON of GiftItems.
+        """
+
+        for product in Product.get_gift_repository(self.db_conn)[:3]:
+            GiftItem.get_new_gift_item(self.db_conn, product)
+        wedding_gifts = WeddingList.get_wedding_gifts(self.db_conn)
+        wedding_gifts[1].purchase()
+
+        self.assertEqual(WeddingList.rows_to_json(self.db_conn),
+                         [dict(gift.to_json(), product=gift.product.to_json())
+                          for gift in wedding_gifts])
+
 
 class TestWeddingListerIntegration(unittest.TestCase):
     """Integration tests for Wedding List Organiser.
@@ -145,12 +213,13 @@ class TestWeddingListerIntegration(unittest.TestCase):
 
         self.client = app.test_client()
         with app.app_context():
-            init_db(get_db())
+            TEMPLATE_DB.backup(get_db())
 
     def tearDown(self):
         """Tear down test context.
         """
 
+        close_pool(app.config['DATABASE'])
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
 
@@ -162,6 +231,19 @@ class TestWeddingListerIntegration(unittest.TestCase):
         json_data = ret_val.get_json()
         self.assertEqual(len(json_data), 20)
 
+    def test_available_gifts_are_priced_in_pounds(self):
+        """Test that available products report their prices in pounds.
+        """
+
+        ret_val = self.client.get('/available-products')
+        json_data = ret_val.get_json()
+
+        self.assertEqual(json_data[0]['name'], "Tea pot")
+        self.assertEqual(json_data[0]['price'], 47,
+                         msg="Tea pot should cost 47.00GBP")
+        self.assertEqual(json_data[3]['price'], 99.99,
+                         msg="Hand mixer should cost 99.99GBP")
+
     def test_can_add_gift_to_wedding_list(self):
         """Test that we can add a gift to the wedding list.
         """
@@ -184,6 +266,44 @@ class TestWeddingListerIntegration(unittest.TestCase):
         self.assertEqual(len(json_data), 1,
                          msg="Wedding list should have one item")
 
+    def test_can_add_several_gifts_to_wedding_list(self):
+        """Test that we can add several gifts to the wedding list at once.
+        """
+
+        # Add gifts to the list.
+        new_gifts = {"product_ids": [1, 4, 10]}
+        ret_val = self.client.put('/wedding-list/batch', json=new_gifts)
+        json_data = ret_val.get_json()
+
+        self.assertEqual(len(json_data['gift_ids']), 3,
+                         msg="Should have three new gift IDs")
+
+        # Check that the gifts have been added, in order.
+        ret_val = self.client.get('/wedding-list')
+        json_data = ret_val.get_json()
+
+        self.assertEqual([gift['product']['id'] for gift in json_data],
+                         [1, 4, 10],
+                         msg="Wedding list should have the three gifts")
+
+    def test_unknown_product_in_batch_adds_no_gifts(self):
+        """Test that a batch with an unknown product adds none of its gifts.
+        """
+
+        new_gifts = {"product_ids": [1, 999, 10]}
+        ret_val = self.client.put('/wedding-list/batch', json=new_gifts)
+
+        self.assertEqual(ret_val.status_code, 400,
+                         msg="Adding an unknown product should fail")
+        self.assertIn(b"Unknown product ID: 999", ret_val.get_data(),
+                      msg="Error should name the unknown product")
+
+        ret_val = self.client.get('/wedding-list')
+        json_data = ret_val.get_json()
+
+        self.assertEqual(len(json_data), 0,
+                         msg="Wedding list should still be empty")
+
     def test_can_remove_gift_from_wedding_list(self):
         """Test that we can remove a gift from the wedding list.
         """
@@ -352,3 +472,55 @@ class TestWeddingListerIntegration(unittest.TestCase):
                         msg="Wedding list report should have purchased gifts")
         self.assertEqual(len(json_data['not_purchased_gifts']), 2,
                          msg="Wedding list should have two non-purchased gifts")
+
+    def test_unknown_gift_is_bad_request(self):
+        """Test that purchasing or removing an unknown gift is a bad request.
+        """
+
+        ret_val = self.client.patch('/wedding-list/999',
+                                    json={"purchase": True})
+
+        self.assertEqual(ret_val.status_code, 400,
+                         msg="Purchasing an unknown gift should fail")
+
+        ret_val = self.client.delete('/wedding-list/999')
+
+        self.assertEqual(ret_val.status_code, 400,
+                         msg="Removing an unknown gift should fail")
+
+    def test_available_gifts_show_purchases(self):
+        """Test that purchasing a gift is reflected in the available products.
+        """
+
+        ret_val = self.client.get('/available-products')
+        original_stock_level = ret_val.get_json()[0]['in_stock_quantity']
+
+        # Add a gift to the list and purchase it.
+        new_gift = {"product_id": 1}
+        ret_val = self.client.put('/wedding-list', json=new_gift)
+        gift_id = ret_val.get_json()['gift_id']
+        self.client.patch('/wedding-list/%d' % gift_id,
+                          json={"purchase": True})
+
+        # Check that the product's stock level has gone down.
+        ret_val = self.client.get('/available-products')
+
+        self.assertEqual(ret_val.get_json()[0]['in_stock_quantity'],
+                         original_stock_level - 1,
+                         msg="Purchased product should have less stock")
+
+    def test_invalid_gift_request_is_bad_request(self):
+        """Test that adding a gift with an invalid request is a bad request.
+        """
+
+        for new_gift in ({}, {"product_id": "1"}, {"product_id": True},
+                         {"product_id": 999}):
+            ret_val = self.client.put('/wedding-list', json=new_gift)
+
+            self.assertEqual(ret_val.status_code, 400,
+                             msg="Adding %s should fail" % new_gift)
+
+        ret_val = self.client.put('/wedding-list', data="not JSON")
+
+        self.assertEqual(ret_val.status_code, 400,
+                         msg="Adding a gift without JSON should fail")
@@ -53,105 +53,270 @@
     POSSIBILITY OF SUCH DAMAGE.
 """
 
+import functools
+import queue
 import sqlite3
+import threading
+import time
 
-from flask.json import JSONEncoder
+import orjson
 from flask import g
+from flask import has_app_context
 from flask import Flask
 from flask import request
-from flask import jsonify
+from flask import Response
 from werkzeug.exceptions import BadRequest
 
 from model import Product
 from model import GiftItem
 from model import WeddingList
+from model import UnknownGift
+from model import UnknownProduct
 
 # For some reason pylint does not like the Flask logger
 #pylint: disable=no-member
 
-class CustomJSONEncoder(JSONEncoder):
-    """Customer JSON Encoder.
+# Types encoded through their to_json method. Matched by exact type, so any
+# subclasses must be added explicitly.
+JSON_TYPES = frozenset((Product, GiftItem, WeddingList))
+
+
+def json_default(obj):
+    """Convert objects orjson does not know about to JSON-serializable ones.
+
+    Args:
+        obj: object to be encoded as JSON.
+
+    Raises:
+        TypeError if obj cannot be encoded as JSON.
+    """
+    if type(obj) in JSON_TYPES:
+        return obj.to_json()
+
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+app = Flask(__name__, static_folder=None)
+
+# Number of idle connections kept open for reuse, per database file.
+POOL_SIZE = 4
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Cached GET response bodies, keyed by database file and request path.
+_response_cache = {}
+# Bumped on every invalidation, so not the constant pylint takes it for.
+_response_cache_generation = 0 #pylint: disable=invalid-name
+_response_cache_lock = threading.Lock()
+
+
+def jsonify_fast(obj):
+    """Create a JSON response using the orjson encoder.
+
+    WeddingList is passed to json_default rather than encoded as a plain list,
+    so that it is reported in its two sections.
+
+    Args:
+        obj: object to be encoded as JSON.
+
+    Returns:
+        a JSON response.
     """
+    return Response(orjson.dumps(obj, default=json_default,
+                                 option=orjson.OPT_PASSTHROUGH_SUBCLASS),
+                    mimetype='application/json')
 
-    #pylint: disable=arguments-differ
-    def default(self, obj):
-        """Encode to JSON.
 
-        Args:
-            obj: object to be encoded as JSON.
-        """
-        if isinstance(obj, (Product, GiftItem, WeddingList)):
-            return obj.to_json
+def cached_response(timeout):
+    """Decorator caching the body of a view's response for a short time.
 
-        return JSONEncoder.default(self, obj)
+    Any view that changes the database must call invalidate_responses so that
+    the change is seen immediately rather than once the cache expires.
 
+    Args:
+        timeout: number of seconds to reuse a cached response for.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def cached_view(*args, **kwargs):
+            key = (app.config['DATABASE'], request.path)
+            cached = _response_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return Response(cached[1], mimetype=cached[2])
+
+            generation = _response_cache_generation
+            response = view(*args, **kwargs)
+            if response.status_code == 200:
+                body = response.get_data()
+                with _response_cache_lock:
+                    # Don't cache a response built before the last
+                    # invalidation.
+                    if generation == _response_cache_generation:
+                        _response_cache[key] = (time.monotonic() + timeout,
+                                                body, response.mimetype)
+            return response
+
+        return cached_view
+
+    return decorator
+
+
+def invalidate_responses():
+    """Discard all cached responses after the database has changed.
+    """
 
-app = Flask(__name__)
-app.json_encoder = CustomJSONEncoder
+    #pylint: disable=global-statement
+    global _response_cache_generation
+    with _response_cache_lock:
+        _response_cache_generation += 1
+        _response_cache.clear()
 
 
 @app.route('/available-products', methods=['GET'])
+@cached_response(timeout=60)
 def available_products():
     """List of available products in the system.
     """
-    return jsonify(Product.get_gift_repository(get_db()))
+    return jsonify_fast(Product.rows_to_json(get_db()))
 
 
 @app.route('/wedding-list', methods=['GET'])
+@cached_response(timeout=30)
 def get_wedding_list():
     """List of wedding gifts, drawn from the available products.
     """
-    return jsonify(WeddingList.get_wedding_gifts(get_db()))
+    return jsonify_fast(WeddingList.rows_to_json(get_db()))
 
 
 @app.route('/wedding-list-report', methods=['GET'])
+@cached_response(timeout=30)
 def get_wedding_list_report():
     """List detailed report of wedding gifts.
     """
-    return jsonify(WeddingList(WeddingList.get_wedding_gifts(get_db())))
+    return jsonify_fast(WeddingList.get_report(get_db()))
 
 
 @app.route('/wedding-list', methods=['PUT'])
 def add_to_wedding_list():
     """Put gift into list of wedding gifts.
     """
-    db_conn = get_db()
-    wedding_gifts = WeddingList.get_wedding_gifts(db_conn)
-    new_gift = GiftItem.\
-        get_new_gift_item(db_conn, Product.
-                          get_product_by_id(db_conn,
-                                            request.json["product_id"]))
-    wedding_gifts.append(new_gift)
-    return jsonify({"gift_id": new_gift.gift_id})
+    product_id = get_json_field(get_json_body(), "product_id", int)
+    try:
+        gift_id = GiftItem.get_new_gift_id(get_db(), product_id)
+    except UnknownProduct:
+        raise BadRequest(f"Unknown product ID: {product_id}") from None
+    invalidate_responses()
+    return jsonify_fast({"gift_id": gift_id})
+
+
+@app.route('/wedding-list/batch', methods=['PUT'])
+def add_many_to_wedding_list():
+    """Put several gifts into list of wedding gifts at once.
+    """
+    product_ids = get_json_field(get_json_body(), "product_ids", list)
+    # Exact type check, since bool is a subclass of int.
+    #pylint: disable=unidiomatic-typecheck
+    if any(type(product_id) is not int for product_id in product_ids):
+        raise BadRequest("Field product_ids must be a list of int")
+
+    try:
+        gift_ids = GiftItem.get_new_gift_ids(get_db(), product_ids)
+    except UnknownProduct as exc:
+        raise BadRequest(f"Unknown product ID: {exc.args[0]}") from None
+    invalidate_responses()
+    return jsonify_fast({"gift_ids": gift_ids})
 
 
 @app.route('/wedding-list/<int:gift_id>', methods=['PATCH'])
 def purchase_gift_from_wedding_list(gift_id):
     """Purchase gift from wedding list.
     """
-    if request.json["purchase"]:
-        db_conn = get_db()
-        wedding_gifts = WeddingList.get_wedding_gifts(db_conn)
-        found_gift = [gift for gift in wedding_gifts if gift.gift_id == gift_id]
-        if len(found_gift) == 0:
-            raise BadRequest("Unknown gift ID: %d" % gift_id)
-        found_gift[0].purchase()
-    return jsonify({})
+    if not get_json_field(get_json_body(), "purchase", bool, required=False):
+        # Nothing to do, so don't touch the database or the response cache.
+        return jsonify_fast({})
+
+    find_gift(get_db(), gift_id).purchase()
+    invalidate_responses()
+    return jsonify_fast({})
 
 
 @app.route('/wedding-list/<int:gift_id>', methods=['DELETE'])
 def remove_from_wedding_list(gift_id):
     """Remove gift from list of wedding gifts.
     """
-    db_conn = get_db()
-    wedding_gifts = WeddingList.get_wedding_gifts(db_conn)
-    found_gift = [gift for gift in wedding_gifts if gift.gift_id == gift_id]
-    if len(found_gift) == 0:
-        raise BadRequest("Unknown gift ID: %d" % gift_id)
-    wedding_gifts.remove(found_gift[0])
-    # This could be incorporated into the list remove functionality.
-    found_gift[0].remove()
-    return jsonify({})
+    find_gift(get_db(), gift_id).remove()
+    invalidate_responses()
+    return jsonify_fast({})
+
+
+def find_gift(db_conn, gift_id):
+    """Look up a gift on the wedding list for a request.
+
+    Args:
+        db_conn: sqlite3 database context.
+        gift_id: ID of the gift to look up.
+
+    Returns:
+        GiftItem that was found.
+
+    Raises:
+        BadRequest if the gift is not on the wedding list.
+    """
+    try:
+        return GiftItem.get_by_id(db_conn, gift_id)
+    except UnknownGift:
+        raise BadRequest(f"Unknown gift ID: {gift_id}") from None
+
+
+def get_json_body():
+    """Parse the JSON body of the current request.
+
+    Returns:
+        dictionary of the request's JSON object.
+
+    Raises:
+        BadRequest if the body is not a JSON object.
+    """
+    try:
+        body = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        raise BadRequest("Request body is not valid JSON") from None
+
+    if not isinstance(body, dict):
+        raise BadRequest("Request body must be a JSON object")
+    return body
+
+
+def get_json_field(body, name, field_type, required=True):
+    """Get a field of a request's JSON body, checking its type.
+
+    Args:
+        body: dictionary from get_json_body.
+        name: name of the field.
+        field_type: type the field's value must be exactly, e.g. int excludes
+            bool.
+        required: if False a missing field gives None rather than an error.
+
+    Returns:
+        value of the field.
+
+    Raises:
+        BadRequest if the field is missing or has the wrong type.
+    """
+    if name not in body:
+        if required:
+            raise BadRequest(f"Missing field: {name}")
+        return None
+
+    value = body[name]
+    # Exact type check, so a bool is not accepted where an int is expected.
+    #pylint: disable=unidiomatic-typecheck
+    if type(value) is not field_type:
+        raise BadRequest(f"Field {name} must be of type "
+                         f"{field_type.__name__}")
+    return value
 
 
 def get_db(db_path=None):
@@ -164,81 +329,162 @@ def get_db(db_path=None):
         a sqlite3 database connection
     """
 
-    try:
-        db_conn = getattr(g, '_database', None)
-    except RuntimeError:
+    if not has_app_context():
         # We might get here if we've attempted to get a database connection
         # before the app is running.
         _db_path = db_path if db_path is not None else app.config['DATABASE']
         db_conn = sqlite3.connect(_db_path)
+        configure_db(db_conn)
         return db_conn
 
+    db_conn = g.get('_database')
     if db_conn is None:
         # Allow for different paths to the database, e.g. for testing.
         _db_path = db_path if db_path is not None else app.config['DATABASE']
-        db_conn = g._database = sqlite3.connect(_db_path)
+        db_conn = g._database = _acquire_connection(_db_path)
+        # Remembered so the connection goes back to the right pool.
+        g._database_path = _db_path #pylint: disable=protected-access
     return db_conn
 
 
-def init_db(db_conn):
-    """Initialise database; if sqlite3 database file is missing create it.
+def _get_pool(db_path):
+    """Get the pool of idle connections to a database file.
 
     Args:
-        db_conn: sqlite3 database context.
+        db_path: path to database file.
+
+    Returns:
+        a queue of idle sqlite3 database connections.
     """
 
-    app.logger.info("Determining if database has schema")
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return _pools[db_path]
 
-    with app.app_context():
 
-        app.logger.info("Determining if database has schema")
+def _acquire_connection(db_path):
+    """Take an idle connection from the pool, opening one if there are none.
+
+    Args:
+        db_path: path to database file.
+
+    Returns:
+        a sqlite3 database connection
+    """
 
-        cur = db_conn.cursor()
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        rows = cur.fetchall()
+    try:
+        return _get_pool(db_path).get_nowait()
+    except queue.Empty:
+        # Pooled connections may be handed to any request thread.
+        db_conn = sqlite3.connect(db_path, check_same_thread=False)
+        configure_db(db_conn)
+        return db_conn
 
-        if ('products',) not in rows:
 
-            app.logger.warning("Database is missing schema, setting up...")
+def _release_connection(db_path, db_conn):
+    """Return a connection to the pool, closing it if the pool is full.
 
-            with app.open_resource('schema.sql', mode='r') as schema_file:
+    Args:
+        db_path: path to database file.
+        db_conn: sqlite3 database connection from _acquire_connection.
+    """
+
+    if db_conn.in_transaction:
+        # Don't leak a failed request's uncommitted writes into the next one.
+        db_conn.rollback()
 
-                app.logger.info("Creating database schema")
+    try:
+        _get_pool(db_path).put_nowait(db_conn)
+    except queue.Full:
+        db_conn.close()
 
-                db_conn.cursor().executescript(schema_file.read())
 
-                app.logger.info("Adding example products")
+def close_pool(db_path):
+    """Close all idle pooled connections to a database file.
 
-                cur = db_conn.cursor()
-                # Add example gift repository.
-                gift_repo = Product.get_example_gift_repository(db_conn)
-                for gift in gift_repo:
-                    gift_tuple = (gift.product_id,
-                                  gift.name,
-                                  gift.brand,
-                                  gift.price / 100.,
-                                  gift.in_stock_quantity)
+    Args:
+        db_path: path to database file.
+    """
 
-                    cur.execute("""INSERT INTO products
-                                   (rowid, name, brand, price, in_stock_quantity)
-                                   VALUES (?, ?, ?, ?, ?)""", gift_tuple)
+    with _pools_lock:
+        pool = _pools.pop(db_path, None)
 
-            db_conn.commit()
+    while pool is not None and not pool.empty():
+        pool.get_nowait().close()
 
-            app.logger.info("Finished creating database schema")
+
+def configure_db(db_conn):
+    """Tune a freshly opened sqlite3 database connection.
+
+    Write-ahead logging appends to the log on commit rather than rewriting
+    pages through a rollback journal, so it only needs to sync at checkpoints.
+    It also lets readers carry on while a write is in progress, and memory
+    mapping the database file lets reads avoid a system call per page.
+
+    Args:
+        db_conn: sqlite3 database context.
+    """
+
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    db_conn.execute("PRAGMA temp_store=MEMORY")
+    db_conn.execute("PRAGMA cache_size=-64000")
+    db_conn.execute("PRAGMA mmap_size=268435456")
+
+
+def init_db(db_conn):
+    """Initialise database; create any missing schema and example products.
+
+    Safe to run on every start: existing tables and products are left as
+    they are.
+
+    Args:
+        db_conn: sqlite3 database context.
+    """
+
+    with app.app_context():
+
+        with app.open_resource('schema.sql', mode='r') as schema_file:
+
+            app.logger.info("Creating any missing database schema")
+
+            db_conn.cursor().executescript(schema_file.read())
+
+        app.logger.info("Adding any missing example products")
+
+        # Add example gift repository in a single transaction.
+        gift_repo = Product.get_example_gift_repository(db_conn)
+        gift_tuples = ((gift.product_id,
+                        gift.name,
+                        gift.brand,
+                        gift.price,
+                        gift.in_stock_quantity) for gift in gift_repo)
+
+        # Prices are stored in pounds, as they always have been. SQLite does
+        # the conversion from pence as it inserts each row.
+        with db_conn:
+            db_conn.executemany(
+                """INSERT OR IGNORE INTO products
+                   (rowid, name, brand, price, in_stock_quantity)
+                   VALUES (?, ?, ?, ? / 100.0, ?)""", gift_tuples)
+
+        app.logger.info("Finished setting up database")
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """Close database connection upon app context teardown.
+    """Return database connection to the pool upon app context teardown.
     """
 
     if exception:
-        app.logger.error(exception)
+        app.logger.error("Exception during app context teardown",
+                         exc_info=exception)
 
     db_conn = getattr(g, '_database', None)
     if db_conn is not None:
-        db_conn.close()
+        #pylint: disable=protected-access
+        _release_connection(g._database_path, db_conn)
 
 
 if __name__ == '__main__':